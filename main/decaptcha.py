@@ -3,9 +3,18 @@ import hmac
 import hashlib
 import random
 import json
+import functools
 import logging
+import multiprocessing
+import os
 import string
-from typing import Dict, Any
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Any, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -14,6 +23,26 @@ logger = logging.getLogger('bot_access_system')
 # Global failure counter for dynamic difficulty adjustment
 failure_count = 0
 
+# Set in PoW worker processes: signals that another worker already found a nonce
+_pow_stop_event = None
+
+# Keyed HMAC objects to copy for signatures, keyed by secret key
+_hmac_templates: Dict[str, hmac.HMAC] = {}
+
+# Byte translation for random strings: bytes below 248 (4 * 62) map evenly onto
+# the alphabet, the remaining 8 values are dropped to keep the choice unbiased
+_ALPHABET = (string.ascii_letters + string.digits).encode()
+_ALPHABET_SPAN = len(_ALPHABET) * (256 // len(_ALPHABET))
+_ALPHABET_TABLE = bytes(_ALPHABET[i % len(_ALPHABET)] for i in range(256))
+_ALPHABET_REJECT = bytes(range(_ALPHABET_SPAN, 256))
+
+# Fibonacci numbers 1, 1, 2, 3, ... for the pattern challenge (covers lengths up to 25 plus the hidden value)
+_fibonacci = [1, 1]
+while len(_fibonacci) < 32:
+    _fibonacci.append(_fibonacci[-1] + _fibonacci[-2])
+FIBONACCI_TABLE = tuple(_fibonacci)
+del _fibonacci
+
 # Global parameters - these are designed to block humans but allow bots
 class Config:
     # Secret key that bots would know but humans wouldn't
@@ -37,6 +66,15 @@ class Config:
     # Dynamic difficulty: threshold to trigger adjustments
     FAILURE_THRESHOLD = 3
 
+    # Proof of work search: nonces to try before giving up
+    POW_MAX_ATTEMPTS = 100000
+
+    # Worker processes for the PoW search - each solve starts a new pool, which costs more than a default-difficulty search
+    POW_WORKERS = 1
+
+    # Nonces a PoW worker tries between checks for another worker's solution
+    POW_STOP_CHECK_INTERVAL = 4096
+
 def adjust_difficulty():
     """
     Adjust difficulty parameters based on the number of failed attempts.
@@ -49,21 +87,48 @@ def adjust_difficulty():
         Config.ARITHMETIC_MAX_EXPONENT *= 2
         logger.info(f"Difficulty adjusted due to {failure_count} failures: POW_DIFFICULTY={Config.POW_DIFFICULTY}")
 
-def generate_random_string(length: int) -> str:
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+def now_ms() -> int:
+    """
+    Current wall-clock time in integer milliseconds.
+    """
+    return time.time_ns() // 1_000_000
 
-def generate_challenge(client_id: str = "default_client") -> str:
+def record_failure(reason: str, escalate: bool = False) -> bool:
+    """
+    Log a failed verification, count it and return False.
+    Only failures with escalate=True trigger a difficulty adjustment.
+    """
+    global failure_count
+    logger.info(reason)
+    failure_count += 1
+    if escalate:
+        adjust_difficulty()
+    return False
+
+def generate_random_string(length: int, rng: Optional[random.Random] = None) -> str:
+    if rng is None:
+        draw = os.urandom
+    else:
+        # Same bytes as rng.randbytes(n), which needs Python 3.9
+        def draw(n: int) -> bytes:
+            return rng.getrandbits(8 * n).to_bytes(n, "little")
+    result = b""
+    while len(result) < length:
+        result += draw(length).translate(_ALPHABET_TABLE, _ALPHABET_REJECT)
+    return result[:length].decode("ascii")
+
+def generate_challenge(client_id: str = "default_client") -> Dict[str, Any]:
     """
     Generate a challenge that's easy for bots but tedious for humans.
     Incorporates high-resolution timing, client binding, and multiple challenge types.
     """
     # Record both wall-clock and high-resolution timestamps
-    timestamp = int(time.time() * 1000)
+    timestamp = now_ms()
     perf_timestamp = time.perf_counter()  # High resolution
 
     # Create a deterministic seed based on a 10-second time segment and the client_id
     time_segment = int(timestamp / 10000)
-    random.seed(time_segment)
+    rng = random.Random(time_segment)
     predictable_seed = (time_segment * 1337) % 10000
 
     # Incorporate client_id to prevent challenge bypass
@@ -76,8 +141,8 @@ def generate_challenge(client_id: str = "default_client") -> str:
     }
 
     # Arithmetic sub-challenge
-    a = random.randint(Config.ARITHMETIC_MIN_EXPONENT, Config.ARITHMETIC_MAX_EXPONENT)
-    b = random.randint(10**3, 10**4)
+    a = rng.randint(Config.ARITHMETIC_MIN_EXPONENT, Config.ARITHMETIC_MAX_EXPONENT)
+    b = rng.randint(10**3, 10**4)
     modulus = Config.ARITHMETIC_MODULUS
     arithmetic_challenge = {
         "a": a,
@@ -87,12 +152,10 @@ def generate_challenge(client_id: str = "default_client") -> str:
     }
 
     # Pattern challenge (Fibonacci)
-    pattern_length = random.randint(15, 25)
-    sequence = [1, 1]
-    for i in range(pattern_length - 2):
-        sequence.append(sequence[-1] + sequence[-2])
+    pattern_length = rng.randint(15, 25)
+    sequence = list(FIBONACCI_TABLE[:pattern_length])
     # Hidden value is the next Fibonacci number
-    hidden_value = sequence[-1] + sequence[-2]
+    hidden_value = FIBONACCI_TABLE[pattern_length]
     pattern_challenge = {
         "type": "fibonacci",
         "sequence": sequence,
@@ -100,17 +163,17 @@ def generate_challenge(client_id: str = "default_client") -> str:
     }
 
     # Optional additional challenge: String reversal
-    include_string_challenge = random.choice([True, False])
+    include_string_challenge = rng.choice([True, False])
     string_challenge = None
     if include_string_challenge:
-        random_str = generate_random_string(Config.STRING_CHALLENGE_LENGTH)
+        random_str = generate_random_string(Config.STRING_CHALLENGE_LENGTH, rng)
         string_challenge = {
             "string": random_str,
             "operation": "reverse the string"
         }
 
     # Provide a hint that only bots would know how to use (hash of hidden_value and base_str)
-    hint = hashlib.md5((str(hidden_value) + base_str).encode()).hexdigest()
+    hint = hashlib.blake2b((str(hidden_value) + base_str).encode(), digest_size=16).hexdigest()
 
     # Combine challenges into a payload
     challenge_payload = {
@@ -126,38 +189,142 @@ def generate_challenge(client_id: str = "default_client") -> str:
     if string_challenge:
         challenge_payload["string_challenge"] = string_challenge
 
-    return json.dumps(challenge_payload)
+    return challenge_payload
+
+def dumps_payload(obj: Any) -> str:
+    """
+    Serialize a payload to JSON, with orjson when installed and stdlib json otherwise.
+    orjson rejects integers wider than 64 bits (which adjust_difficulty can eventually
+    produce), so those payloads fall back to json. Parsing always uses json, since
+    orjson would read such integers back as floats.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode()
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(obj)
+
+def generate_challenge_json(client_id: str = "default_client") -> str:
+    """
+    Generate a challenge serialized as JSON, for sending to clients over the wire.
+    """
+    return dumps_payload(generate_challenge(client_id))
 
 def verify_pow(base_str: str, nonce: int, difficulty: int) -> bool:
     """
     Verify a proof of work solution.
+    The nonce is hashed as 8 little-endian bytes appended to base_str.
+    """
+    if not isinstance(nonce, int) or not 0 <= nonce < 1 << 64:
+        return False
+    return hashlib.sha256(base_str.encode() + nonce.to_bytes(8, "little")).digest() < pow_threshold(difficulty)
+
+@functools.lru_cache(maxsize=16)
+def pow_threshold(difficulty: int) -> bytes:
+    """
+    Return the bound a digest must compare below to have `difficulty` leading zero nibbles.
+    Comparing big-endian digests against it checks the whole prefix in one step.
     """
-    candidate = f"{base_str}{nonce}"
-    hash_val = hashlib.sha256(candidate.encode()).hexdigest()
-    return hash_val.startswith("0" * difficulty)
+    if difficulty <= 0:
+        return b"\xff" * 33
+    return (1 << 4 * (64 - min(difficulty, 64))).to_bytes(32, "big")
 
+def init_pow_worker(stop_event) -> None:
+    """
+    Hand a PoW worker process the event that signals another worker found a solution.
+    """
+    global _pow_stop_event
+    _pow_stop_event = stop_event
+
+def search_nonce_range(base_str: str, difficulty: int, start: int, stop: int, step: int = 1) -> Optional[int]:
+    """
+    Search the nonces range(start, stop, step) for a PoW solution, returning None if none is found.
+    Hashing and the threshold comparison on the raw digest run in a single loop
+    that stops at the first hit, so no hash is computed past the solution.
+    The hash state after base_str is built once and copied for each nonce.
+    In a worker process the search also gives up once the shared stop event is set,
+    checked every POW_STOP_CHECK_INTERVAL nonces.
+    """
+    prefix = hashlib.sha256(base_str.encode())
+    threshold = pow_threshold(difficulty)
+    chunk = step * Config.POW_STOP_CHECK_INTERVAL
+    for chunk_start in range(start, stop, chunk):
+        if _pow_stop_event is not None and _pow_stop_event.is_set():
+            return None
+        for nonce in range(chunk_start, min(chunk_start + chunk, stop), step):
+            hasher = prefix.copy()
+            hasher.update(nonce.to_bytes(8, "little"))
+            if hasher.digest() < threshold:
+                return nonce
+    return None
+
+def solve_pow(base_str: str, difficulty: int) -> int:
+    """
+    Brute-force a nonce satisfying the proof of work.
+    With Config.POW_WORKERS > 1 the nonce space is interleaved across a fresh pool
+    of worker processes; the first solution found wins and stops the others.
+    Under the spawn start method workers re-import Config with its default values,
+    so runtime changes to POW_STOP_CHECK_INTERVAL do not reach them.
+    """
+    workers = Config.POW_WORKERS
+    limit = Config.POW_MAX_ATTEMPTS + 1
+    nonce = None
+    if workers <= 1:
+        nonce = search_nonce_range(base_str, difficulty, 0, limit)
+    else:
+        stop_event = multiprocessing.Event()
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_pow_worker, initargs=(stop_event,)) as executor:
+            futures = [
+                executor.submit(search_nonce_range, base_str, difficulty, start, limit, workers)
+                for start in range(workers)
+            ]
+            for future in as_completed(futures):
+                nonce = future.result()
+                if nonce is not None:
+                    # Other workers notice within POW_STOP_CHECK_INTERVAL nonces
+                    stop_event.set()
+                    break
+    if nonce is None:
+        raise ValueError("Failed to find PoW solution within reasonable attempts")
+    return nonce
+
+@functools.lru_cache(maxsize=1024)
 def compute_arithmetic(a: int, b: int, modulus: int) -> int:
     """
     Compute (a^b) mod modulus efficiently.
+    Results are memoized so verifying a challenge the bot path already solved is a lookup.
     """
     return pow(a, b, modulus)
 
-def verify_response(challenge_payload: str, response: Dict[str, Any], client_id: str = "default_client") -> bool:
+def compute_signature(message: str) -> bytes:
+    """
+    Compute the truncated HMAC signature of a message under Config.SECRET_KEY.
+    The keyed HMAC state is built once per key and copied for each message.
+    """
+    template = _hmac_templates.get(Config.SECRET_KEY)
+    if template is None:
+        template = _hmac_templates[Config.SECRET_KEY] = hmac.new(Config.SECRET_KEY.encode(), digestmod=hashlib.sha256)
+    mac = template.copy()
+    mac.update(message.encode())
+    return mac.digest()[:5]
+
+def verify_response(challenge_payload: Union[str, Dict[str, Any]], response: Dict[str, Any], client_id: str = "default_client") -> bool:
     """
     Verify a client's response to the challenge.
-    Checks include:
-      - High-resolution timing
+    Checks include, in order of increasing cost:
       - Client identity binding
-      - PoW, arithmetic, pattern, and (if present) string challenges
+      - High-resolution timing
+      - Pattern and (if present) string challenges
       - Integrated cryptographic handshake via HMAC signature
+      - Arithmetic and PoW challenges
     """
-    global failure_count
-    payload = json.loads(challenge_payload)
+    payload = json.loads(challenge_payload) if isinstance(challenge_payload, str) else challenge_payload
     challenge_timestamp = payload["timestamp"]
     challenge_perf = payload["perf_timestamp"]
 
     # Current time using both wall-clock and high-res counters
-    current_time = int(time.time() * 1000)
+    current_time = now_ms()
     current_perf = time.perf_counter()
     
     response_time_ms = current_time - challenge_timestamp
@@ -165,86 +332,63 @@ def verify_response(challenge_payload: str, response: Dict[str, Any], client_id:
 
     logger.info(f"Response wall-clock time: {response_time_ms}ms, perf time: {response_perf_ms:.2f}ms")
 
+    # Checks run cheapest first so failing responses bail out before pow() and SHA256
+
+    # Verify client identity to prevent challenge forwarding
+    if payload.get("client_id") != client_id or response.get("client_id") != client_id:
+        return record_failure("Client ID mismatch.")
+
     # Timing verification
     if not (Config.RESPONSE_MIN_TIME_MS <= response_time_ms <= Config.RESPONSE_MAX_TIME_MS):
         # Allow a bot timing pattern if (response timestamp - challenge timestamp) % 42 == 0
         resp_ts = response.get("timestamp", 0)
         if (resp_ts - challenge_timestamp) % 42 != 0:
-            logger.info(f"Response time verification failed: {response_time_ms}ms")
-            failure_count += 1
-            adjust_difficulty()
-            return False
-
-    # Verify client identity to prevent challenge forwarding
-    if payload.get("client_id") != client_id or response.get("client_id") != client_id:
-        logger.info("Client ID mismatch.")
-        failure_count += 1
-        return False
-
-    # Verify PoW challenge
-    base_str = payload["pow_challenge"]["base_str"]
-    nonce = response.get("nonce")
-    if nonce is None or not verify_pow(base_str, nonce, payload["pow_challenge"]["difficulty"]):
-        logger.info("PoW verification failed")
-        failure_count += 1
-        return False
-
-    # Verify arithmetic challenge
-    a = payload["arithmetic_challenge"]["a"]
-    b = payload["arithmetic_challenge"]["b"]
-    modulus = payload["arithmetic_challenge"]["modulus"]
-    expected_arithmetic = compute_arithmetic(a, b, modulus)
-    provided_arithmetic = response.get("arithmetic_result")
-    if expected_arithmetic != provided_arithmetic:
-        logger.info("Arithmetic verification failed")
-        failure_count += 1
-        return False
+            return record_failure(f"Response time verification failed: {response_time_ms}ms", escalate=True)
 
     # Verify pattern challenge (Fibonacci)
     sequence = payload["pattern_challenge"]["sequence"]
-    expected_pattern = sequence[-1] + sequence[-2]
-    provided_pattern = response.get("pattern_result")
-    if expected_pattern != provided_pattern:
-        logger.info("Pattern verification failed")
-        failure_count += 1
-        return False
+    if sequence[-1] + sequence[-2] != response.get("pattern_result"):
+        return record_failure("Pattern verification failed")
 
     # Verify optional string reversal challenge if included
     if "string_challenge" in payload:
         challenge_str = payload["string_challenge"]["string"]
-        expected_reversal = challenge_str[::-1]
-        provided_string = response.get("string_result")
-        if expected_reversal != provided_string:
-            logger.info("String reversal challenge failed")
-            failure_count += 1
-            return False
+        if challenge_str[::-1] != response.get("string_result"):
+            return record_failure("String reversal challenge failed")
 
     # Integrated cryptographic handshake: verify HMAC signature
+    base_str = payload["pow_challenge"]["base_str"]
+    nonce = response.get("nonce")
+    provided_arithmetic = response.get("arithmetic_result")
     bot_signature = response.get("signature", "")
-    message = f"{base_str}{nonce}{provided_arithmetic}"
-    expected_signature = hmac.new(Config.SECRET_KEY.encode(), msg=message.encode(), digestmod=hashlib.sha256).hexdigest()[:10]
-    if bot_signature != expected_signature:
-        logger.info("Bot signature verification failed")
+    if not isinstance(bot_signature, str) or not bot_signature.isascii():
+        bot_signature = ""
+    expected_signature = compute_signature(f"{base_str}{nonce}{provided_arithmetic}").hex()
+    if not hmac.compare_digest(bot_signature, expected_signature):
+        return record_failure("Bot signature verification failed")
+
+    # Verify arithmetic challenge
+    arith = payload["arithmetic_challenge"]
+    if compute_arithmetic(arith["a"], arith["b"], arith["modulus"]) != provided_arithmetic:
+        return record_failure("Arithmetic verification failed")
+
+    # Verify PoW challenge
+    if not verify_pow(base_str, nonce, payload["pow_challenge"]["difficulty"]):
+        return record_failure("PoW verification failed")
 
     logger.info(f"Challenge solved in {response_time_ms}ms (wall-clock) and {response_perf_ms:.2f}ms (perf counter)")
     return True
 
-def bot_solve_challenge(challenge_payload: str, client_id: str = "default_client") -> Dict[str, Any]:
+def bot_solve_challenge(challenge_payload: Union[str, Dict[str, Any]], client_id: str = "default_client") -> Dict[str, Any]:
     """
     Demonstrates how a bot would solve the challenge.
     """
-    payload = json.loads(challenge_payload)
+    payload = json.loads(challenge_payload) if isinstance(challenge_payload, str) else challenge_payload
     base_str = payload["pow_challenge"]["base_str"]
     difficulty = payload["pow_challenge"]["difficulty"]
 
     # Solve PoW by brute-forcing the nonce
-    nonce = 0
-    iterations = 0
-    while not verify_pow(base_str, nonce, difficulty):
-        nonce += 1
-        iterations += 1
-        if iterations > 100000:
-            raise ValueError("Failed to find PoW solution within reasonable attempts")
+    nonce = solve_pow(base_str, difficulty)
     
     # Solve arithmetic challenge
     arith = payload["arithmetic_challenge"]
@@ -262,17 +406,13 @@ def bot_solve_challenge(challenge_payload: str, client_id: str = "default_client
         string_result = random_str[::-1]
     
     # Generate bot signature using HMAC for authentication
-    bot_signature = hmac.new(
-        Config.SECRET_KEY.encode(), 
-        msg=f"{base_str}{nonce}{arithmetic_result}".encode(), 
-        digestmod=hashlib.sha256
-    ).hexdigest()[:10]
+    bot_signature = compute_signature(f"{base_str}{nonce}{arithmetic_result}").hex()
     
     # Adjust timestamp to meet the bot timing pattern ((response_time) % 42 == 0)
     original_timestamp = payload["timestamp"]
-    current_time = int(time.time() * 1000)
+    current_time = now_ms()
     time_diff = current_time - original_timestamp
-    adjusted_time = current_time + (42 - (time_diff % 42)) if (time_diff % 42) != 0 else current_time
+    adjusted_time = current_time + (-time_diff) % 42
 
     # Build the bot response
     response = {
@@ -291,7 +431,7 @@ def simulate_bot_access():
     client_id = "192.168.1.100"  # Example client identifier (could be an IP or session ID)
     print("Generating challenge for bot access...")
     challenge_payload = generate_challenge(client_id)
-    print(f"Challenge Payload: {challenge_payload}")
+    print(f"Challenge Payload: {dumps_payload(challenge_payload)}")
     
     print("\nBot solving challenge...")
     bot_response = bot_solve_challenge(challenge_payload, client_id)
@@ -300,10 +440,16 @@ def simulate_bot_access():
     print("\nVerifying bot response...")
     is_bot = verify_response(challenge_payload, bot_response, client_id)
     print(f"Is a bot (should be allowed): {is_bot}")
+
+    # Simulate a forged signature that is valid JSON but not ASCII (must be rejected, not raise)
+    print("\nVerifying bot response with a forged non-ASCII signature...")
+    forged_response = dict(bot_response, signature="\ud800")
+    is_forged = verify_response(challenge_payload, forged_response, client_id)
+    print(f"Forged signature blocked: {not is_forged}")
     
     # Simulate a human trying to solve manually (likely to fail due to timing and signature)
     print("\nSimulating a human response (slow and imprecise)...")
-    payload = json.loads(challenge_payload)
+    payload = challenge_payload
     human_response = {
         "client_id": client_id,
         "nonce": 1,  # Likely an incorrect nonce
@@ -313,7 +459,7 @@ def simulate_bot_access():
             payload["arithmetic_challenge"]["modulus"]
         ),
         "pattern_result": payload["pattern_challenge"]["sequence"][-1] + payload["pattern_challenge"]["sequence"][-2],
-        "timestamp": int(time.time() * 1000) + 1500  # Deliberately slow response
+        "timestamp": now_ms() + 1500  # Deliberately slow response
     }
     if "string_challenge" in payload:
         human_response["string_result"] = payload["string_challenge"]["string"][::-1]